@@ -1,12 +1,21 @@
+import asyncio
+import contextlib
+import html
 import logging
-import json
+import re
 import sys
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 
-from bs4 import BeautifulSoup
-import requests
+import httpx
+import orjson
+import pybreaker
+from cachetools import TTLCache
 from pydukeenergy.meter import Meter
 from pprint import pformat
+from tenacity import (retry, retry_if_exception_type, retry_if_result, stop_after_attempt,
+                      wait_exponential_jitter)
 from typing import Optional
 
 
@@ -16,14 +25,168 @@ USAGE_ANALYSIS_URL = BASE_URL + "api/UsageAnalysis/"
 BILLING_INFORMATION_URL = USAGE_ANALYSIS_URL + "GetBillingInformation"
 METER_ACTIVE_URL = BASE_URL + "my-account/usage-analysis"
 USAGE_CHART_URL = USAGE_ANALYSIS_URL + "GetUsageChartData"
+GET_USAGE_XML_URL = BASE_URL + "form/PlanRate/GetEnergyUsage"
 
-USER_AGENT = {"User-Agent": "python/{}.{} pyduke-energy/0.0.6"}
-LOGIN_HEADERS = {"Content-Type": "application/json"}
-USAGE_ANALYSIS_HEADERS = {"Content-Type": "application/json", "Accept": "application/json, text/plain, */*"}
+USER_AGENT = {"User-Agent": "python/{}.{} pyduke-energy/0.0.6".format(sys.version_info.major,
+                                                                       sys.version_info.minor)}
+LOGIN_HEADERS = {"Content-Type": "application/json", **USER_AGENT}
+USAGE_ANALYSIS_HEADERS = {"Content-Type": "application/json", "Accept": "application/json, text/plain, */*",
+                          **USER_AGENT}
+# The parts of the usage chart request that never change.
+USAGE_CHART_BODY = {
+    "Graph": "DailyEnergy",
+    "BillingFrequency": "Week",
+    "GraphText": "Daily Energy and Avg. ",
+}
+
+POOL_MAXSIZE = 10
+POOL_MAX_KEEPALIVE = 5
+KEEPALIVE_TIMEOUT = 30
+REQUEST_TIMEOUT = 10.0
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.5
+# Longest we sleep between attempts, whether backing off or honouring Retry-After.
+RETRY_BACKOFF_MAX = 30
+RETRY_STATUS_FORCELIST = frozenset([429, 500, 502, 503, 504])
+RETRY_EXCEPTIONS = (httpx.TransportError, httpx.TooManyRedirects)
+BREAKER_FAIL_MAX = 5
+BREAKER_RESET_TIMEOUT = 60
+RESPONSE_CACHE_SIZE = 64
+STREAM_CHUNK_SIZE = 8192
+XML_PROLOGUE_CHUNK_SIZE = 1024
+MAX_CONCURRENT_REQUESTS = 4
+# Below the two requests refresh_meters() makes per meter, so one meter can never hold more than
+# one of the MAX_CONCURRENT_REQUESTS slots.
+METER_MAX_CONCURRENT_REQUESTS = 1
+# Share of the update interval refresh_meters() may take before unfinished requests are cancelled.
+REFRESH_TIMEOUT_RATIO = 0.8
+AUTH_TTL = 30 * 60
+ACCOUNTS_TTL = 60 * 60
+AUTH_FAILURE_STATUSES = frozenset([401, 403])
+
+METER_DROPDOWN_TAG = "<duke-dropdown"
+METER_DROPDOWN_ID = "usageAnalysisMeter"
+# A complete <duke-dropdown> start tag. Quoted attribute values may contain ">".
+METER_DROPDOWN_RE = re.compile(r'''<duke-dropdown(?=[\s/>])((?:[^>"']|"[^"]*"|'[^']*')*)>''')
+# A <duke-dropdown> start tag at the end of the buffer that is still missing its ">".
+METER_DROPDOWN_PARTIAL_RE = re.compile(
+    r'''<duke-dropdown(?:[\s/](?:[^>"']|"[^"]*"|'[^']*')*(?:"[^"]*|'[^']*)?)?\Z''')
+TAG_ATTRIBUTE_RE = re.compile(r'''([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?''')
+XML_PROLOGUE = b"<?xml"
+# UTF-8 byte order mark and whitespace that may precede the XML declaration.
+XML_LEADING_BYTES = b"\xef\xbb\xbf \t\r\n"
 
 _LOGGER = logging.getLogger(__name__)
 
 
+def _retry_after(response) -> Optional[float]:
+    """
+    Seconds to wait according to the Retry-After header, given either as a number of
+    seconds or as an HTTP date.
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _read_json(response):
+    return orjson.loads(response.content)
+
+
+def _tag_attributes(text: str) -> dict:
+    attributes = {}
+    for name, double_quoted, single_quoted, unquoted in TAG_ATTRIBUTE_RE.findall(text):
+        attributes.setdefault(name.lower(), double_quoted or single_quoted or unquoted)
+    return attributes
+
+
+def _find_meter_dropdown(buffer: str):
+    """
+    Look for the start tag of the meter dropdown in buffer. Returns its attributes once the
+    whole tag is there, otherwise None and the tail of buffer that may still become the tag
+    as more of the page arrives.
+    """
+    pos = 0
+    for match in METER_DROPDOWN_RE.finditer(buffer):
+        attributes = _tag_attributes(match.group(1))
+        if attributes.get("id") == METER_DROPDOWN_ID:
+            return attributes, ""
+        pos = match.end()
+    partial = METER_DROPDOWN_PARTIAL_RE.search(buffer, pos)
+    if partial:
+        return None, buffer[partial.start():]
+    # Too short to hold a whole "<duke-dropdown", but it may be the start of one.
+    return None, buffer[-(len(METER_DROPDOWN_TAG) - 1):]
+
+
+def _response_of(result) -> httpx.Response:
+    """
+    The streaming helpers return (response, body); everything else returns the response.
+    """
+    return result[0] if isinstance(result, tuple) else result
+
+
+def _is_retryable_status(result) -> bool:
+    return _response_of(result).status_code in RETRY_STATUS_FORCELIST
+
+
+_backoff = wait_exponential_jitter(multiplier=RETRY_BACKOFF_FACTOR, max=RETRY_BACKOFF_MAX, jitter=0.5)
+
+
+def _wait_retry_after(retry_state) -> float:
+    """
+    Wait as long as the server asked for in Retry-After, up to RETRY_BACKOFF_MAX, otherwise
+    back off exponentially.
+    """
+    if not retry_state.outcome.failed:
+        delay = _retry_after(_response_of(retry_state.outcome.result()))
+        if delay is not None:
+            return min(delay, RETRY_BACKOFF_MAX)
+    return _backoff(retry_state)
+
+
+def _log_retry(retry_state):
+    if retry_state.outcome.failed:
+        reason = repr(retry_state.outcome.exception())
+    else:
+        reason = "status {}".format(_response_of(retry_state.outcome.result()).status_code)
+    _LOGGER.debug("%s failed (%s), retrying in %.1f seconds", retry_state.fn.__name__, reason,
+                  retry_state.next_action.sleep)
+
+
+def _last_outcome(retry_state):
+    """
+    Hand back the last response, or re-raise the last exception, once retries are exhausted.
+    """
+    return retry_state.outcome.result()
+
+
+class DukeEnergyException(Exception):
+    pass
+
+class DukeEnergyPostException(Exception):
+    pass
+
+class DukeEnergyTransientException(Exception):
+    pass
+
+class DukeEnergyServerException(Exception):
+    def __init__(self, response):
+        super().__init__("Server error: {}".format(response.status_code))
+        self.response = response
+
+
 class DukeEnergy(object):
     """
     API interface object.
@@ -37,59 +200,256 @@ class DukeEnergy(object):
             password (str): Duke Energy account password.
             update_interval (int): How often an update should occur. (Min=10)
         """
-        global USER_AGENT, LOGIN_HEADERS
-        version_info = sys.version_info
-        major = version_info.major
-        minor = version_info.minor
-        USER_AGENT["User-Agent"] = USER_AGENT["User-Agent"].format(major, minor)
-        LOGIN_HEADERS.update(USER_AGENT)
         self.email = email
         self.password = password
         self.meters = []
-        self.session = requests.Session()
-        self.session.headers.update(LOGIN_HEADERS)
+        self.client = None
         self.update_interval = update_interval
-        if not self._login():
-            raise DukeEnergyException("")
-        if not self.get_account_number():
-            raise DukeEnergyException("")
+        # A cancelled request says nothing about the server, and DukeEnergyException is ours.
+        # pybreaker counts excluded exceptions as successes; _calling() undoes that for cancellations.
+        self._breaker_storage = pybreaker.CircuitMemoryStorage(pybreaker.STATE_CLOSED)
+        self._breaker = pybreaker.CircuitBreaker(fail_max=BREAKER_FAIL_MAX, reset_timeout=BREAKER_RESET_TIMEOUT,
+                                                 exclude=[asyncio.CancelledError, DukeEnergyException],
+                                                 state_storage=self._breaker_storage)
+        self._breaker_trial = False
+        self._last_good = {}
+        self._request_sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        self._meter_sem = {}
+        self._last_auth_ts = None
+        self._login_lock = asyncio.Lock()
+        self._accounts_cached_at = None
+        # update_interval is in minutes
+        self._resp_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=update_interval * 60)
+
+    @classmethod
+    async def create(cls, email, password, update_interval=60):
+        """
+        Create the Duke Energy API interface object and log in.
+        Takes the same arguments as the constructor.
+        """
+        duke = cls(email, password, update_interval)
+        try:
+            if not await duke._login():
+                raise DukeEnergyException("")
+            if not duke.get_account_number():
+                raise DukeEnergyException("")
+        except BaseException:
+            await duke.close()
+            raise
+        return duke
+
+    async def close(self):
+        """
+        Close the underlying HTTP client.
+        """
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _ensure_client(self) -> httpx.AsyncClient:
+        if self.client is None or self.client.is_closed:
+            # Every endpoint lives on one host, so with HTTP/2 concurrent requests share a
+            # single multiplexed connection.
+            limits = httpx.Limits(max_connections=POOL_MAXSIZE,
+                                  max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                                  keepalive_expiry=KEEPALIVE_TIMEOUT)
+            self.client = httpx.AsyncClient(http2=True,
+                                            headers=LOGIN_HEADERS,
+                                            timeout=REQUEST_TIMEOUT,
+                                            limits=limits,
+                                            follow_redirects=True)
+        return self.client
+
+    @retry(stop=stop_after_attempt(RETRY_TOTAL + 1),
+           wait=_wait_retry_after,
+           retry=retry_if_exception_type(RETRY_EXCEPTIONS) | retry_if_result(_is_retryable_status),
+           before_sleep=_log_retry,
+           retry_error_callback=_last_outcome)
+    async def _send(self, method, url, **kwargs) -> httpx.Response:
+        """
+        Send a request on the shared client. Connection errors, timeouts and retryable status
+        codes are retried with exponential backoff, honouring Retry-After. Each attempt takes
+        one of the request slots while it is on the wire; the backoff between attempts doesn't.
+        """
+        async with self._request_sem:
+            return await self._ensure_client().request(method, url, **kwargs)
+
+    async def _request(self, method, url, **kwargs) -> httpx.Response:
+        """
+        Send a request through the circuit breaker. Once the retries in _send() have been
+        exhausted, connection errors and 5xx responses count as failures; after enough of
+        them the breaker opens and raises pybreaker.CircuitBreakerError without calling out.
+        """
+        try:
+            with self._calling():
+                response = await self._send(method, url, **kwargs)
+                if response.status_code >= 500:
+                    raise DukeEnergyServerException(response)
+        except DukeEnergyServerException as e:
+            # Counted against the breaker, but callers still get to inspect the response.
+            return e.response
+        return response
+
+    @contextlib.contextmanager
+    def _calling(self):
+        """
+        Run the block through the circuit breaker. pybreaker lets every caller through while
+        it is half-open; here only the first one gets out and the rest fail fast until it
+        finishes. A cancelled block proves nothing either way: the failure count is left as it
+        was, and a cancelled trial opens the circuit again.
+        """
+        if self._breaker_trial:
+            raise pybreaker.CircuitBreakerError("Trial call in progress, circuit breaker still half-open")
+        trial = False
+        failures = 0
+        try:
+            with self._breaker.calling():
+                trial = self._breaker_trial = self._breaker.current_state == pybreaker.STATE_HALF_OPEN
+                try:
+                    yield
+                except asyncio.CancelledError:
+                    failures = self._breaker.fail_counter
+                    raise
+        except asyncio.CancelledError:
+            if trial:
+                self._breaker.open()
+            else:
+                # The exclusion went through pybreaker's success path, which reset the count.
+                while self._breaker.fail_counter < failures:
+                    self._breaker_storage.increment_counter()
+            raise
+        finally:
+            if trial:
+                self._breaker_trial = False
 
-    def get_meters(self):
-        self._get_meters()
+    def _serve_stale(self, meter, kind) -> bool:
+        """
+        Put the last good billing or usage chart data back on the meter, if there is any.
+        """
+        data = self._last_good.get(meter.id, {}).get(kind)
+        if data is None:
+            return False
+        if kind == "billing":
+            meter.set_billing_usage(data)
+        else:
+            meter.set_chart_usage(data)
+        return True
+
+    def _is_logged_in(self) -> bool:
+        """
+        True while we hold session cookies from a login that is younger than AUTH_TTL.
+        """
+        return (self.client is not None and len(self.client.cookies) > 0
+                and self._last_auth_ts is not None and time.monotonic() - self._last_auth_ts < AUTH_TTL)
+
+    async def _ensure_authenticated(self) -> bool:
+        """
+        Log in unless we already hold a fresh login. Concurrent callers share a single login.
+        """
+        if self._is_logged_in():
+            return True
+        async with self._login_lock:
+            # Another caller may have logged in while we were waiting for the lock.
+            return self._is_logged_in() or await self._login()
+
+    async def get_meters(self):
+        await self._get_meters()
         return self.meters
 
-    def get_billing_info(self, meter):
+    async def refresh_all(self):
+        """
+        Pull the billing info and usage chart data for all meters; see refresh_meters().
+        """
+        return await self.refresh_meters(self.meters)
+
+    async def refresh_meters(self, meters):
+        """
+        Pull the billing info and usage chart data for the given meters concurrently.
+        A meter only has METER_MAX_CONCURRENT_REQUESTS of its requests in flight at a time, so
+        a slow one holds at most that many of the shared request slots. Whatever is still
+        running after most of the update interval is cancelled. If a request raises or is
+        cancelled, that meter falls back to its last good data.
+        """
+        jobs = []
+        for meter in meters:
+            jobs.append((meter, "billing", self._isolated(meter, self.get_billing_info)))
+            jobs.append((meter, "chart", self._isolated(meter, self.get_usage_chart_data)))
+        if not jobs:
+            return []
+        tasks = [asyncio.ensure_future(job) for _, _, job in jobs]
+        # update_interval is in minutes
+        _, pending = await asyncio.wait(tasks, timeout=self.update_interval * 60 * REFRESH_TIMEOUT_RATIO)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        results = []
+        for (meter, kind, _), task in zip(jobs, tasks):
+            if task in pending:
+                _LOGGER.warning("Updating %s for meter %s timed out; serving stale data", kind, meter.id)
+                results.append(self._serve_stale(meter, kind))
+            elif task.exception() is not None:
+                _LOGGER.warning("Updating %s for meter %s failed (%r); serving stale data", kind, meter.id,
+                                task.exception())
+                results.append(self._serve_stale(meter, kind))
+            else:
+                results.append(task.result())
+        return results
+
+    async def _isolated(self, meter, fetch):
+        """
+        Call fetch(meter) inside that meter's own semaphore. The coroutine is only created once
+        the semaphore is held, so cancelling a task that is still waiting leaves nothing behind.
+        """
+        sem = self._meter_sem.get(meter.id)
+        if sem is None:
+            sem = self._meter_sem[meter.id] = asyncio.Semaphore(METER_MAX_CONCURRENT_REQUESTS)
+        async with sem:
+            return await fetch(meter)
+
+    async def get_billing_info(self, meter):
         """
         Pull the billing info for the meter.
         """
-        if self.session.cookies or self._login():
-            post_body = {"MeterNumber": meter.type + " - " + meter.id}
-            headers = USAGE_ANALYSIS_HEADERS.copy()
-            headers.update(USER_AGENT)
-            response = self.session.post(BILLING_INFORMATION_URL, data=json.dumps(post_body), headers=headers,
-                                         timeout=10)
-            _LOGGER.debug(str(response.content))
-            try:
-                if response.status_code != 200:
-                    _LOGGER.error("Billing info request failed: " + response.status_code)
-                    self._logout()
-                    return False
-                if response.json()["Status"] == "ERROR":
-                    self._logout()
-                    return False
-                if response.json()["Status"] == "OK":
-                    meter.set_billing_usage(response.json()["Data"][-1])
-                    return True
-                else:
-                    _LOGGER.error("Status was {}".format(response.json()["Status"]))
-                    self._logout()
-                    return False
-            except Exception as e:
-                _LOGGER.exception("Something went wrong. Logging out and trying again.")
+        key = (BILLING_INFORMATION_URL, meter.billing_request_body)
+        billing = self._resp_cache.get(key)
+        if billing is not None:
+            meter.set_billing_usage(billing)
+            return True
+        try:
+            if not await self._ensure_authenticated():
+                return False
+            response = await self._request("post", BILLING_INFORMATION_URL, content=meter.billing_request_body,
+                                           headers=USAGE_ANALYSIS_HEADERS)
+        except pybreaker.CircuitBreakerError:
+            _LOGGER.warning("circuit open; serving stale data")
+            return self._serve_stale(meter, "billing")
+        _LOGGER.debug("Response: %r", response.content)
+        try:
+            if response.status_code in AUTH_FAILURE_STATUSES:
+                _LOGGER.error("Billing info request was not authorized: %s", response.status_code)
                 self._logout()
                 return False
+            if response.status_code != 200:
+                _LOGGER.error("Billing info request failed: %s", response.status_code)
+                return False
+            data = _read_json(response)
+            status = data.get("Status")
+            if status == "ERROR":
+                return False
+            if status == "OK":
+                billing = data["Data"][-1]
+                meter.set_billing_usage(billing)
+                self._last_good.setdefault(meter.id, {})["billing"] = billing
+                self._resp_cache[key] = billing
+                return True
+            else:
+                _LOGGER.error("Status was {}".format(status))
+                return False
+        except Exception as e:
+            _LOGGER.exception("Something went wrong.")
+            return False
 
-    def get_usage_chart_data(self, meter):
+    async def get_usage_chart_data(self, meter):
         """
         billing_frequency ["Week", "Billing Cycle", "Month"]
         graph ["hourlyEnergyUse", "DailyEnergy", "averageEnergyByDayOfWeek"]
@@ -98,102 +458,116 @@ class DukeEnergy(object):
             the_date = meter.date - timedelta(days=1)
         else:
             the_date = meter.date
-        if self.session.cookies or self._login():
-            post_body = {
-                "Graph": "DailyEnergy",
-                "BillingFrequency": "Week",
-                "GraphText": "Daily Energy and Avg. ",
-                "Date": the_date.strftime("%m / %d / %Y"),
-                "MeterNumber": meter.type + " - " + meter.id,
-                "ActiveDate": meter.start_date
-            }
-            headers = USAGE_ANALYSIS_HEADERS.copy()
-            headers.update(USER_AGENT)
-            response = self.session.post(USAGE_CHART_URL, data=json.dumps(post_body), headers=headers, timeout=10)
-            _LOGGER.debug(str(response.content))
-            try:
-                if response.status_code != 200:
-                    _LOGGER.error("Usage data request failed: " +
-                                  response.status_code)
-                    self._logout()
-                    return False
-                if response.json()["Status"] == "ERROR":
-                    self._logout()
-                    return False
-                if response.json()["Status"] == "OK":
-                    meter.set_chart_usage(response.json())
-                    return True
-                else:
-                    self._logout()
-                    return False
-            except Exception as e:
-                _LOGGER.exception("Something went wrong. Logging out and trying again.")
+        post_body = {
+            **USAGE_CHART_BODY,
+            "Date": f"{the_date.month:02d} / {the_date.day:02d} / {the_date.year}",
+            "MeterNumber": meter.meter_number,
+            "ActiveDate": meter.start_date
+        }
+        body = orjson.dumps(post_body)
+        key = (USAGE_CHART_URL, body)
+        data = self._resp_cache.get(key)
+        if data is not None:
+            meter.set_chart_usage(data)
+            return True
+        try:
+            if not await self._ensure_authenticated():
+                return False
+            response = await self._request("post", USAGE_CHART_URL, content=body,
+                                           headers=USAGE_ANALYSIS_HEADERS)
+        except pybreaker.CircuitBreakerError:
+            _LOGGER.warning("circuit open; serving stale data")
+            return self._serve_stale(meter, "chart")
+        _LOGGER.debug("Response: %r", response.content)
+        try:
+            if response.status_code in AUTH_FAILURE_STATUSES:
+                _LOGGER.error("Usage data request was not authorized: %s", response.status_code)
                 self._logout()
                 return False
+            if response.status_code != 200:
+                _LOGGER.error("Usage data request failed: %s", response.status_code)
+                return False
+            data = _read_json(response)
+            status = data.get("Status")
+            if status == "ERROR":
+                return False
+            if status == "OK":
+                meter.set_chart_usage(data)
+                self._last_good.setdefault(meter.id, {})["chart"] = data
+                self._resp_cache[key] = data
+                return True
+            else:
+                return False
+        except Exception as e:
+            _LOGGER.exception("Something went wrong.")
+            return False
 
-    def _post(self, url, payload) -> requests.models.Response:
+    async def _post(self, url, payload) -> httpx.Response:
         if isinstance(payload, dict):
-            response = self.session.post(url, json=payload,
-                                         headers=LOGIN_HEADERS,
-                                         timeout=10,
-                                         allow_redirects=False)
+            content = orjson.dumps(payload)
         elif isinstance(payload, str):
-            response = self.session.post(url, data=payload,
-                                         headers=LOGIN_HEADERS,
-                                         timeout=10,
-                                         allow_redirects=False)
+            content = payload
         else:
             _LOGGER.error("Unsupported type of payload: %s", type(payload))
             raise DukeEnergyPostException
+        response = await self._request("post", url, content=content, headers=LOGIN_HEADERS,
+                                       follow_redirects=False)
         if response.status_code != 200:
             _LOGGER.debug("Status code %d", response.status_code)
             raise DukeEnergyPostException
         return response
 
-    def _post_and_check_json_status(self, url, payload) -> Optional[dict]:
-        response = self._post(url, payload)
-        if response.json():
-            json = response.json()
+    async def _post_and_check_json_status(self, url, payload) -> Optional[dict]:
+        response = await self._post(url, payload)
+        json = _read_json(response)
+        if json:
             if 'Status' in json.keys():
                 if json['Status'] == "Success":
-                    return response.json()
+                    return json
                 else:
                     _LOGGER.debug("Returned Status is '%s'", json['Status'])
                     if 'MessageText' in json.keys():
                         _LOGGER.debug("MessageText = '%s'",
                                       json['MessageText'])
-            else:
+            elif _LOGGER.isEnabledFor(logging.DEBUG):
                 _LOGGER.debug("Returned JSON doesn't have 'Status' key.\n %s",
                               pformat(json))
-        else:
+        elif _LOGGER.isEnabledFor(logging.DEBUG):
             # trim response text to 400 chars
-            _LOGGER.debug("Response is not JSON:\n%s",response.text[:400])
+            _LOGGER.debug("Response is not JSON:\n%s", response.text[:400])
         return None
 
-    def _login(self) -> bool:
+    async def _login(self) -> bool:
         """
         Authenticate. This creates a cookie on the session which is used to authenticate with
         the other calls. Unfortunately the service always returns 200 even if you have a wrong
         password.
         """
         _LOGGER.debug("Logging in...")
-        if not self._post_and_check_json_status(LOGIN_URL,
+        if not await self._post_and_check_json_status(LOGIN_URL,
                     {"loginIdentity": self.email, "password": self.password}):
             _LOGGER.error("Login failed")
             return False
+        self._last_auth_ts = time.monotonic()
+
+        # Accounts rarely change, so a cookie refresh doesn't need to fetch them again.
+        if self._accounts_cached_at is not None and time.monotonic() - self._accounts_cached_at < ACCOUNTS_TTL:
+            return True
 
         # getting Accounts info.
-        json = self._post_and_check_json_status(
+        json = await self._post_and_check_json_status(
             BASE_URL+"facade/api/AccountSelector/GetResiAccounts",
             {"email":""})
         if json:
             self.GetResiAccountsResponse = json
+            self._accounts_cached_at = time.monotonic()
             if 'CdpId' in json.keys():
                 self.cdp = json['CdpId']
             else:
                 self.cdp = None
-                _LOGGER.debug("Can't find 'CdpId' in 'GetResiAccounts' response:\n",
-                              pformat(json))
+                if _LOGGER.isEnabledFor(logging.DEBUG):
+                    _LOGGER.debug("Can't find 'CdpId' in 'GetResiAccounts' response:\n%s",
+                                  pformat(json))
         return True
 
     def _logout(self):
@@ -201,25 +575,61 @@ class DukeEnergy(object):
         Delete the session.
         """
         _LOGGER.debug("Logging out.")
-        self.session.cookies.clear()
+        self._last_auth_ts = None
+        if self.client is not None:
+            self.client.cookies.clear()
 
-    def _get_meters(self):
+    async def _get_meters(self):
         """
         There doesn't appear to be a service to get this data.
         Collecting the meter info to build meter objects.
         """
-        if self._login():
-            response = self.session.get(METER_ACTIVE_URL, timeout=10)
-            _LOGGER.debug(str(response.text))
-            soup = BeautifulSoup(response.text, "html.parser")
-            meter_data = json.loads(soup.find("duke-dropdown", {"id": "usageAnalysisMeter"})["items"])
-            _LOGGER.debug(str(meter_data))
+        if await self._ensure_authenticated():
+            try:
+                with self._calling():
+                    response, items = await self._stream_meter_items()
+                    if response.status_code >= 500:
+                        raise DukeEnergyServerException(response)
+            except DukeEnergyServerException as e:
+                raise DukeEnergyException("Usage analysis page request failed: {}".format(
+                    e.response.status_code)) from e
+            if response.status_code in AUTH_FAILURE_STATUSES:
+                self._logout()
+                raise DukeEnergyException("Usage analysis page request was not authorized: {}".format(
+                    response.status_code))
+            if response.status_code != 200:
+                raise DukeEnergyException("Usage analysis page request failed: {}".format(response.status_code))
+            if items is None:
+                raise DukeEnergyException("Meter dropdown not found on usage analysis page")
+            meter_data = orjson.loads(html.unescape(items))
+            _LOGGER.debug("Meters: %s", meter_data)
             for meter in meter_data:
                 meter_type, meter_id = meter["text"].split(" - ")
                 meter_start_date = meter["CalendarStartDate"]
-                self.meters.append(Meter(self, meter_type, meter_id, meter_start_date, self.update_interval))
-            self._logout()
+                self.meters.append(Meter(self, meter_type, meter_id, meter_start_date, self.update_interval,
+                                         meter_number=meter["text"]))
+            await self.refresh_all()
 
+    @retry(stop=stop_after_attempt(RETRY_TOTAL + 1),
+           wait=_wait_retry_after,
+           retry=retry_if_exception_type(RETRY_EXCEPTIONS) | retry_if_result(_is_retryable_status),
+           before_sleep=_log_retry,
+           retry_error_callback=_last_outcome)
+    async def _stream_meter_items(self):
+        """
+        Stream the usage analysis page and return the response with the raw items attribute
+        of the meter dropdown, closing the connection as soon as it has been seen. The items
+        are None if the dropdown is missing; the body is not read at all unless the status is 200.
+        """
+        async with self._request_sem, self._ensure_client().stream("GET", METER_ACTIVE_URL) as response:
+            if response.status_code != 200:
+                return response, None
+            buffer = ""
+            async for chunk in response.aiter_text(STREAM_CHUNK_SIZE):
+                dropdown, buffer = _find_meter_dropdown(buffer + chunk)
+                if dropdown is not None:
+                    return response, dropdown.get("items")
+        return response, None
 
     def get_account_number(self):
         """
@@ -237,28 +647,61 @@ class DukeEnergy(object):
         return False
 
 
-    def get_usage_xml(self):
-        if self._login:
-            GET_USAGE_XML_URL = BASE_URL + "form/PlanRate/GetEnergyUsage"
-            GetUsagePayload = {"request":"{\"SrcAcctId\":\"" + self.account + "\",\"SrcAcctId2\":\"\",\"SrcSysCd\":\"ISU\",\"ServiceType\":\"ELECTRIC\"}"}
-            for retrynum in range(3):
-                try:
-                    response = self.session.post(GET_USAGE_XML_URL,
-                                                 json=GetUsagePayload)
-                except requests.exceptions.TooManyRedirects as e:
-                    _LOGGER.debug("got redirection %s, %s", e.response.url,
-                                  e.request)
-                    continue
-                if '<?xml ' in response.text:
-                    _LOGGER.debug("got XML!")
-                    break
-                else:
-                    _LOGGER.debug("failed to get xml")
-            return response.text
-
-class DukeEnergyException(Exception):
-    pass
+    async def get_usage_xml(self) -> Optional[str]:
+        """
+        Fetch the usage XML for the account. Returns None if the login fails, the request is
+        refused, the circuit is open, or the retries run out.
+        """
+        try:
+            if not await self._ensure_authenticated():
+                return None
+            return await self._do_get_usage_xml()
+        except (DukeEnergyException, DukeEnergyPostException, DukeEnergyTransientException,
+                pybreaker.CircuitBreakerError, *RETRY_EXCEPTIONS) as e:
+            _LOGGER.debug("failed to get xml: %r", e)
+            return None
 
-class DukeEnergyPostException(Exception):
-    pass
+    @retry(stop=stop_after_attempt(3),
+           wait=wait_exponential_jitter(multiplier=1, max=RETRY_BACKOFF_MAX, jitter=0.5),
+           retry=retry_if_exception_type(DukeEnergyTransientException),
+           before_sleep=_log_retry,
+           reraise=True)
+    async def _do_get_usage_xml(self) -> str:
+        try:
+            with self._calling():
+                response, text = await self._stream_usage_xml()
+                if response.status_code >= 500:
+                    raise DukeEnergyServerException(response)
+        except DukeEnergyServerException as e:
+            raise DukeEnergyTransientException(str(e)) from e
+        if response.status_code in AUTH_FAILURE_STATUSES:
+            self._logout()
+            raise DukeEnergyException("Usage XML request was not authorized: {}".format(response.status_code))
+        if 400 <= response.status_code < 500:
+            raise DukeEnergyException("Usage XML request failed: {}".format(response.status_code))
+        if text is None:
+            raise DukeEnergyTransientException("Usage XML response is not XML")
+        _LOGGER.debug("got XML!")
+        return text
 
+    @retry(stop=stop_after_attempt(RETRY_TOTAL + 1),
+           wait=_wait_retry_after,
+           retry=retry_if_exception_type(RETRY_EXCEPTIONS),
+           before_sleep=_log_retry,
+           reraise=True)
+    async def _stream_usage_xml(self):
+        """
+        Post the usage XML request and return the response with its decoded body. The body is
+        None, and only its first chunk has been read, if it does not open with an XML declaration.
+        """
+        GetUsagePayload = {"request":"{\"SrcAcctId\":\"" + self.account + "\",\"SrcAcctId2\":\"\",\"SrcSysCd\":\"ISU\",\"ServiceType\":\"ELECTRIC\"}"}
+        async with self._request_sem, self._ensure_client().stream("POST", GET_USAGE_XML_URL,
+                                                                   content=orjson.dumps(GetUsagePayload)) as response:
+            chunks = []
+            async for chunk in response.aiter_bytes(XML_PROLOGUE_CHUNK_SIZE):
+                if not chunks and not chunk.lstrip(XML_LEADING_BYTES).startswith(XML_PROLOGUE):
+                    return response, None
+                chunks.append(chunk)
+        if not chunks:
+            return response, None
+        return response, b"".join(chunks).decode(response.encoding or "utf-8", "replace")
@@ -2,6 +2,8 @@ import logging
 import time
 from datetime import datetime
 
+import orjson
+
 _LOGGER = logging.getLogger(__name__)
 
 
@@ -10,10 +12,13 @@ class Meter(object):
     This is a collection of meter data that we care about.
     """
 
-    def __init__(self, api_interface, meter_type, meter_id, meter_start_date, update_interval):
+    def __init__(self, api_interface, meter_type, meter_id, meter_start_date, update_interval, meter_number=None):
         self.api = api_interface
         self.type = meter_type
         self.id = meter_id
+        # The "<type> - <id>" string the usage analysis endpoints identify meters by.
+        self.meter_number = meter_number or meter_type + " - " + meter_id
+        self.billing_request_body = orjson.dumps({"MeterNumber": self.meter_number})
         self.start_date = meter_start_date
         self.update_interval = 10
         if update_interval > 10:
@@ -27,7 +32,6 @@ class Meter(object):
         self.average_gas = None
         self.unit = None
         self.date = datetime.now()
-        self.update(True)
 
     def set_billing_usage(self, _dict):
         self.billing_days = _dict.get("BillingDays")
@@ -82,10 +86,9 @@ class Meter(object):
     def get_unit(self):
         return self.unit
 
-    def update(self, force=False):
+    async def update(self, force=False):
         if ((datetime.now() - self.date).seconds / 60 >= self.update_interval) or force:
             _LOGGER.info("Getting new meter info")
             self.date = datetime.now()
-            self.api.get_billing_info(self)
-            self.api.get_usage_chart_data(self)
+            await self.api.refresh_meters([self])
 
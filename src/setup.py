@@ -6,8 +6,9 @@ setup(name='pydukeenergy',
       url='http://github.com/w1ll1am23/pyduke-energy',
       author='William Scanlon',
       license='MIT',
-      install_requires=['requests>=2.0', 'beautifulsoup4>=4.6.0'],
+      install_requires=['httpx[http2]>=0.23', 'tenacity>=9.2', 'pybreaker>=0.7',
+                        'cachetools>=4.0', 'orjson>=3.0'],
       tests_require=['mock'],
       test_suite='tests',
-      packages=find_packages(exclude=["dist", "*.test", "*.test.*", "test.*", "test"]),
+      packages=find_packages(exclude=["dist", "*.test", "*.test.*", "test.*", "test", "tests", "tests.*"]),
       zip_safe=True)
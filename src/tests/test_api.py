@@ -0,0 +1,430 @@
+import asyncio
+import html
+import time
+from email.utils import formatdate
+
+import httpx
+import orjson
+import pybreaker
+import pytest
+from tenacity import RetryCallState, wait_none
+
+from pydukeenergy.api import (ACCOUNTS_TTL, BILLING_INFORMATION_URL, BREAKER_FAIL_MAX, METER_DROPDOWN_TAG,
+                              RETRY_BACKOFF_MAX, RETRY_TOTAL, STREAM_CHUNK_SIZE, USAGE_CHART_URL,
+                              XML_PROLOGUE_CHUNK_SIZE, DukeEnergy, DukeEnergyException, DukeEnergyPostException,
+                              _find_meter_dropdown, _retry_after, _wait_retry_after)
+from pydukeenergy.meter import Meter
+
+
+def _duke(handler):
+    duke = DukeEnergy("user@example.com", "password")
+    duke.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return duke
+
+
+async def _slow(request):
+    await asyncio.sleep(1)
+    return httpx.Response(200)
+
+
+def test_cancelled_requests_leave_the_breaker_alone():
+    failures = BREAKER_FAIL_MAX - 1
+
+    async def handler(request):
+        if request.url.params.get("slow"):
+            return await _slow(request)
+        return httpx.Response(503, headers={"Retry-After": "0"})
+
+    async def run():
+        duke = _duke(handler)
+        for _ in range(failures):
+            await duke._request("post", BILLING_INFORMATION_URL)
+        for _ in range(BREAKER_FAIL_MAX):
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(duke._request("post", BILLING_INFORMATION_URL + "?slow=1"), 0.05)
+        counted = duke._breaker.fail_counter, duke._breaker.current_state
+        # The next real failure still trips it.
+        with pytest.raises(pybreaker.CircuitBreakerError):
+            await duke._request("post", BILLING_INFORMATION_URL)
+        await duke.close()
+        return counted
+
+    assert asyncio.run(run()) == (failures, pybreaker.STATE_CLOSED)
+
+
+def test_server_errors_trip_the_breaker():
+    async def handler(request):
+        return httpx.Response(503, headers={"Retry-After": "0"})
+
+    async def run():
+        duke = _duke(handler)
+        for _ in range(BREAKER_FAIL_MAX - 1):
+            response = await duke._request("post", BILLING_INFORMATION_URL)
+            assert response.status_code == 503
+        with pytest.raises(pybreaker.CircuitBreakerError):
+            await duke._request("post", BILLING_INFORMATION_URL)
+        await duke.close()
+        return duke._breaker
+
+    assert asyncio.run(run()).current_state == pybreaker.STATE_OPEN
+
+
+def test_half_open_breaker_lets_one_trial_out():
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200)
+
+    async def run():
+        duke = _duke(handler)
+        duke._breaker.reset_timeout = 0
+        duke._breaker.open()
+        results = await asyncio.gather(*[duke._request("post", BILLING_INFORMATION_URL) for _ in range(3)],
+                                       return_exceptions=True)
+        await duke.close()
+        return duke._breaker, results
+
+    breaker, results = asyncio.run(run())
+    assert len(calls) == 1
+    assert results[0].status_code == 200
+    assert all(isinstance(result, pybreaker.CircuitBreakerError) for result in results[1:])
+    assert breaker.current_state == pybreaker.STATE_CLOSED
+
+
+def test_cancelled_trial_keeps_the_breaker_open():
+    async def run():
+        duke = _duke(_slow)
+        duke._breaker.reset_timeout = 0
+        duke._breaker.open()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(duke._request("post", BILLING_INFORMATION_URL), 0.05)
+        await duke.close()
+        return duke._breaker
+
+    assert asyncio.run(run()).current_state == pybreaker.STATE_OPEN
+
+
+def test_stuck_meters_do_not_starve_the_others():
+    async def handler(request):
+        body = orjson.loads(request.content)
+        if body["MeterNumber"] != "ELECTRIC - 3":
+            await asyncio.sleep(10)
+        if request.url == USAGE_CHART_URL:
+            return httpx.Response(200, json={"Status": "OK", "unitOfMeasure1": "kWh",
+                                             "meterData": {"Electric": [1.0, 2.5]}})
+        return httpx.Response(200, json={"Status": "OK", "Data": [{"BillingDays": 30}]})
+
+    async def run():
+        duke = _duke(handler)
+        # refresh_all() gives up after 80% of a 0.6 second update interval.
+        duke.update_interval = 0.01
+        duke.client.cookies.set("session", "1")
+        duke._last_auth_ts = time.monotonic()
+        duke.meters = [Meter(duke, "ELECTRIC", str(i), "01/01/2020", 10) for i in range(1, 4)]
+        results = await duke.refresh_all()
+        await duke.close()
+        return duke.meters, results
+
+    meters, results = asyncio.run(run())
+    assert results == [False, False, False, False, True, True]
+    assert meters[2].get_days_billed() == 30
+    assert meters[2].get_usage() == 2.5
+
+
+def _unavailable(retry_after):
+    return httpx.Response(503, headers={"Retry-After": retry_after})
+
+
+def test_retry_after_accepts_seconds_and_http_dates():
+    assert _retry_after(_unavailable("0")) == 0
+    assert _retry_after(_unavailable("120")) == 120
+    assert 100 < _retry_after(_unavailable(formatdate(time.time() + 120, usegmt=True))) <= 120
+    assert _retry_after(_unavailable("Wed, 21 Oct 2015 07:28:00 GMT")) == 0
+    assert _retry_after(_unavailable("soon")) is None
+    assert _retry_after(httpx.Response(503)) is None
+
+
+def test_retry_after_is_capped():
+    state = RetryCallState(retry_object=None, fn=None, args=(), kwargs={})
+    state.set_result(_unavailable("3600"))
+    assert _wait_retry_after(state) == RETRY_BACKOFF_MAX
+
+
+METER_ITEMS = html.escape('[{"text": "ELECTRIC - 42", "CalendarStartDate": "01/01/2020"}]')
+METER_DROPDOWN = '<duke-dropdown id="usageAnalysisMeter" items="{}"></duke-dropdown>'.format(METER_ITEMS)
+
+
+def _scan(chunks):
+    buffer = ""
+    for chunk in chunks:
+        dropdown, buffer = _find_meter_dropdown(buffer + chunk)
+        if dropdown is not None:
+            return dropdown.get("items"), buffer
+    return None, buffer
+
+
+def test_meter_dropdown_split_across_chunks():
+    page = "<html><body>" + METER_DROPDOWN + "</body></html>"
+    for i in range(len(page) + 1):
+        assert _scan([page[:i], page[i:]])[0] == METER_ITEMS
+
+
+def test_meter_dropdown_after_other_dropdowns():
+    other = '<duke-dropdown id="usageAnalysisPeriod" items="[]"></duke-dropdown>'
+    items, buffer = _scan([other, "x" * 100000])
+    assert items is None
+    assert len(buffer) < len(METER_DROPDOWN_TAG)
+    assert _scan([other, "x" * 100, METER_DROPDOWN])[0] == METER_ITEMS
+
+
+def test_meter_dropdown_missing():
+    items, buffer = _scan(["<html><body>", "x" * 100000, "</body></html>"])
+    assert items is None
+    assert len(buffer) < len(METER_DROPDOWN_TAG)
+
+
+def test_meter_dropdown_attribute_quoting():
+    tag = "<duke-dropdown label=\"a > b\" id=\'usageAnalysisMeter\' items=\'{}\'>".format(METER_ITEMS)
+    assert _scan([tag[:20], tag[20:]])[0] == METER_ITEMS
+
+
+def test_stream_meter_items():
+    page = "x" * (STREAM_CHUNK_SIZE - 10) + METER_DROPDOWN
+
+    async def handler(request):
+        return httpx.Response(200, text=page)
+
+    async def run():
+        duke = _duke(handler)
+        response, items = await duke._stream_meter_items()
+        await duke.close()
+        return items
+
+    assert asyncio.run(run()) == METER_ITEMS
+
+
+def test_unauthorized_usage_xml_logs_out():
+    async def handler(request):
+        return httpx.Response(401)
+
+    async def run():
+        duke = _duke(handler)
+        duke.account = "123"
+        duke.client.cookies.set("session", "1")
+        duke._last_auth_ts = time.monotonic()
+        with pytest.raises(DukeEnergyException):
+            await duke._do_get_usage_xml()
+        logged_in = duke._is_logged_in()
+        await duke.close()
+        return logged_in
+
+    assert asyncio.run(run()) is False
+
+
+def test_usage_xml_failures_return_none():
+    async def handler(request):
+        if request.url.path.endswith("SignIn"):
+            return httpx.Response(200, json={"Status": "Success"}, headers={"Set-Cookie": "session=1"})
+        return httpx.Response(404)
+
+    async def run():
+        duke = _duke(handler)
+        duke.account = "123"
+        duke._accounts_cached_at = time.monotonic()
+        refused = await duke.get_usage_xml()
+        duke._breaker.open()
+        circuit_open = await duke.get_usage_xml()
+        await duke.close()
+        return refused, circuit_open
+
+    assert asyncio.run(run()) == (None, None)
+
+
+def _logged_in(duke):
+    duke.client.cookies.set("session", "1")
+    duke._last_auth_ts = time.monotonic()
+    return duke
+
+
+@pytest.mark.parametrize("status, page, message", [
+    (503, "Service Unavailable", "request failed: 503"),
+    (401, "Unauthorized", "not authorized: 401"),
+    (404, "Not Found", "request failed: 404"),
+    (200, "<html></html>", "dropdown not found"),
+])
+def test_get_meters_checks_the_page_status(status, page, message):
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        return httpx.Response(status, text=page, headers={"Retry-After": "0"})
+
+    async def run():
+        duke = _logged_in(_duke(handler))
+        with pytest.raises(DukeEnergyException, match=message):
+            await duke._get_meters()
+        state = duke._is_logged_in(), duke._breaker.fail_counter
+        await duke.close()
+        return state
+
+    logged_in, failures = asyncio.run(run())
+    assert len(calls) == (RETRY_TOTAL + 1 if status == 503 else 1)
+    assert failures == (1 if status == 503 else 0)
+    assert logged_in == (status != 401)
+
+
+def test_meter_update_serves_stale_billing_when_it_raises():
+    async def handler(request):
+        if request.url == USAGE_CHART_URL:
+            return httpx.Response(200, json={"Status": "OK", "unitOfMeasure1": "kWh",
+                                             "meterData": {"Electric": [1.0, 2.5]}})
+        raise httpx.DecodingError("garbled billing response", request=request)
+
+    async def run():
+        duke = _logged_in(_duke(handler))
+        meter = Meter(duke, "ELECTRIC", "1", "01/01/2020", 10)
+        duke._last_good[meter.id] = {"billing": {"BillingDays": 29}}
+        await meter.update(force=True)
+        await duke.close()
+        return meter
+
+    meter = asyncio.run(run())
+    assert meter.get_days_billed() == 29
+    assert meter.get_usage() == 2.5
+
+
+def test_create_closes_the_client_when_login_raises(monkeypatch):
+    clients = []
+
+    def ensure_client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(500)))
+            clients.append(self.client)
+        return self.client
+
+    monkeypatch.setattr(DukeEnergy, "_ensure_client", ensure_client)
+    monkeypatch.setattr(DukeEnergy._send.retry, "wait", wait_none())
+    with pytest.raises(DukeEnergyPostException):
+        asyncio.run(DukeEnergy.create("user@example.com", "password"))
+    assert len(clients) == 1 and clients[0].is_closed
+
+
+def _stream_usage_xml(handler):
+    async def run():
+        duke = _duke(handler)
+        duke.account = "123"
+        response, text = await duke._stream_usage_xml()
+        await duke.close()
+        return text
+
+    return asyncio.run(run())
+
+
+def test_usage_xml_rejects_other_content_after_the_first_chunk():
+    pulled = []
+
+    async def body():
+        yield b"<html>" + b"x" * 2 * XML_PROLOGUE_CHUNK_SIZE
+        pulled.append(True)
+        yield b"</html>"
+
+    assert _stream_usage_xml(lambda request: httpx.Response(200, content=body())) is None
+    assert pulled == []
+
+
+@pytest.mark.parametrize("prefix", [b"", b"\xef\xbb\xbf", b"\r\n  \t"])
+def test_usage_xml_accepts_a_bom_or_whitespace(prefix):
+    xml = b'<?xml version="1.0"?><usage>' + b"<day/>" * XML_PROLOGUE_CHUNK_SIZE + b"</usage>"
+    text = _stream_usage_xml(lambda request: httpx.Response(200, content=prefix + xml))
+    assert text.lstrip("\ufeff \t\r\n") == xml.decode()
+
+
+def test_usage_xml_empty_body():
+    assert _stream_usage_xml(lambda request: httpx.Response(200)) is None
+
+
+def test_usage_xml_retries_server_errors(monkeypatch):
+    responses = [httpx.Response(503), httpx.Response(200, content=b'<?xml version="1.0"?><usage/>')]
+
+    async def run():
+        duke = _logged_in(_duke(lambda request: responses.pop(0)))
+        duke.account = "123"
+        xml = await duke.get_usage_xml()
+        await duke.close()
+        return xml
+
+    monkeypatch.setattr(DukeEnergy._do_get_usage_xml.retry, "wait", wait_none())
+    assert asyncio.run(run()) == '<?xml version="1.0"?><usage/>'
+    assert responses == []
+
+
+def _server(calls):
+    async def handler(request):
+        path = request.url.path.rsplit("/", 1)[-1]
+        calls.append(path)
+        if path == "SignIn":
+            # Give concurrent callers the chance to pile up behind the login.
+            await asyncio.sleep(0.01)
+            return httpx.Response(200, json={"Status": "Success"}, headers={"Set-Cookie": "session=1"})
+        if path == "GetResiAccounts":
+            return httpx.Response(200, json={"Status": "Success", "CdpId": "1",
+                                             "Accounts": [{"Status": "Active", "AccountNum": "123"}]})
+        if request.url == USAGE_CHART_URL:
+            return httpx.Response(200, json={"Status": "OK", "unitOfMeasure1": "kWh",
+                                             "meterData": {"Electric": [1.0, 2.5]}})
+        return httpx.Response(200, json={"Status": "OK", "Data": [{"BillingDays": 30}]})
+
+    return handler
+
+
+def test_concurrent_refreshes_share_one_login():
+    calls = []
+
+    async def run():
+        duke = _duke(_server(calls))
+        duke._accounts_cached_at = time.monotonic()
+        duke.meters = [Meter(duke, "ELECTRIC", str(i), "01/01/2020", 10) for i in range(1, 4)]
+        await asyncio.gather(duke.refresh_all(), duke.refresh_all())
+        await duke.close()
+
+    asyncio.run(run())
+    assert calls.count("SignIn") == 1
+
+
+@pytest.mark.parametrize("accounts_age, fetches_accounts", [(60, False), (ACCOUNTS_TTL + 60, True)])
+def test_login_reuses_accounts_within_their_ttl(accounts_age, fetches_accounts):
+    calls = []
+
+    async def run():
+        duke = _duke(_server(calls))
+        assert await duke._login()
+        duke._accounts_cached_at -= accounts_age
+        calls.clear()
+        assert await duke._login()
+        await duke.close()
+
+    asyncio.run(run())
+    assert calls == (["SignIn", "GetResiAccounts"] if fetches_accounts else ["SignIn"])
+
+
+def test_cached_responses_are_applied_without_a_request():
+    calls = []
+
+    async def run():
+        duke = _logged_in(_duke(_server(calls)))
+        first = Meter(duke, "ELECTRIC", "1", "01/01/2020", 10)
+        assert await duke.get_billing_info(first)
+        assert await duke.get_usage_chart_data(first)
+        sent = len(calls)
+        second = Meter(duke, "ELECTRIC", "1", "01/01/2020", 10)
+        assert await duke.get_billing_info(second)
+        assert await duke.get_usage_chart_data(second)
+        await duke.close()
+        return sent, second
+
+    sent, meter = asyncio.run(run())
+    assert sent == 2 and len(calls) == 2
+    assert meter.get_days_billed() == 30
+    assert meter.get_usage() == 2.5